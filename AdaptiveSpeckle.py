@@ -0,0 +1,49 @@
+import numpy as np
+from LocalStatistics import LocalStatistics
+
+class AdaptiveSpeckle():
+
+    def __init__(self, band, windowSize, cu=0.25, mask=None):
+        # local mean and coefficient of variation (ci) of one band, computed once and shared by every weighting,
+        # over the window pixels where mask is not 0
+        localStats = LocalStatistics(band, mask)
+        self.band = band
+        self.window_mean = localStats.mean(windowSize)
+        self.ci = localStats.variation(windowSize)
+        self.cu = cu
+
+    def weights(self, mode, damp=1.0):
+        # weight w_t of the pixel value against the window mean for the 'Lee', 'Kuan' or 'Enhanced Lee' filter
+        cu, ci = self.cu, self.ci
+        two_cu = cu * cu
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            if mode == 'Enhanced Lee':
+                cmax = np.sqrt(1.0 + 2.0 * two_cu)      # cu = 1/sqrt(looks), cmax = sqrt(1 + 2/looks)
+                w_t = 1.0 - np.exp(-damp * (ci - cu) / (cmax - ci))
+                return np.where(ci <= cu, 0.0, np.where(ci >= cmax, 1.0, w_t))
+
+            two_ci = ci * ci
+            two_ci[two_ci == 0] = 0.1
+            w_t = 1.0 - (two_cu / two_ci)
+            if mode == 'Kuan':
+                w_t /= 1.0 + two_cu
+            return np.where(cu > ci, 0.0, w_t)
+
+    def filter(self, mode, damp=1.0):
+        w_t = self.weights(mode, damp)
+        with np.errstate(invalid='ignore'):
+            return (self.band * w_t) + (self.window_mean * (1.0 - w_t))
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+"""
+References:
+    [1]. J. S. Lee. Digital image enhancement and noise filtering by use of local statistics.
+    IEEE Transactions on Pattern Analysis and Machine Intelligence, 2(2), 1980, pp. 165-168.
+
+    [2]. D. T. Kuan, A. A. Sawchuk, T. C. Strand and P. Chavel. Adaptive restoration of images with speckle.
+    IEEE Transactions on Acoustics, Speech and Signal Processing, 35(3), 1987, pp. 373-383.
+
+    [3]. A. Lopes, R. Touzi and E. Nezry. Adaptive speckle filters and scene heterogeneity.
+    IEEE Transactions on Geoscience and Remote Sensing, 28(6), 1990, pp. 992-1000.
+"""
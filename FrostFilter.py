@@ -2,8 +2,8 @@ import math
 import numpy as np
 from scipy import ndimage as ndi, stats
 from scipy.signal import medfilt
-from scipy.stats import variation
 from numpy import ndarray
+from LocalStatistics import LocalStatistics, cropPadding
 
 class FrostFilter():
 
@@ -38,14 +38,25 @@ class FrostFilter():
                 'displayName': "Damping Factor",
                 'description': "The damping factor determines the amount of exponential damping and the default value of 1 is sufficient for most radar images. Larger damping values preserve edges better but smooth less, and smaller values smooth more. A damping value of 0 results in the same output as a low pass filter."
             },
+            {
+                'name': 'chunk',
+                'dataType': 'numeric',
+                'value': 64,
+                'required': False,
+                'displayName': "Chunk Size (MB)",
+                'description': "Approximate memory used for the moving windows of one chunk of rows. Larger chunks are faster but use more memory."
+            },
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties': 4 | 8,           # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # no padding to the input pixel block.
-          'inputMask': False                    # input mask in .updatePixels() not required.
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave masked pixels (NoData and the fill outside the raster) out of the windows
          }
 
     def updateRasterInfo(self, **kwargs):
@@ -54,6 +65,7 @@ class FrostFilter():
         self.windowSize = windowSizeTemp if (windowSizeTemp % 2 != 0) else windowSizeTemp + 1
 
         self.dampFactor = kwargs['damp']
+        self.chunkSize = int(kwargs.get('chunk', 64)) << 20
 
         self.bandCount = kwargs['raster_info']['bandCount']
                 
@@ -67,48 +79,52 @@ class FrostFilter():
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
-        row = r.shape[1]
-        col = r.shape[2]
-        win_offset = int(self.windowSize/2)
         outBlockMultiband = np.zeros_like(r)
+        mask = pixelBlocks.get('raster_mask')
 
         for band in xrange(self.bandCount):
-            for i in xrange(row):
-                xleft = i - win_offset
-                xright = i + win_offset
-                if xleft < 0:
-                    xleft = 0
-                if xright >= row:
-                    xright = row
-                for j in xrange(col):
-                    yup = j - win_offset
-                    ydown = j + win_offset
-                    if yup < 0:
-                        yup = 0
-                    if ydown >= col:
-                        ydown = col
-
-                    window = r[band][xleft:xright, yup:ydown]
-                    variation_coef = variation(window, None)
-                    window_mean = window.mean()
-                    sigma_zero = variation_coef / window_mean
-                    factor_A = self.dampFactor * sigma_zero
-                    window_flat = window.flatten()
-                    weights_array = np.zeros(window.size)
-                    N, M = window.shape
-                    center_pixel = np.float64(window[N / 2, M / 2])
-                    window_flat = np.float64(window_flat)
-                    distances = np.abs(window_flat - center_pixel)
-
-                    weights_array = np.exp(-factor_A * distances)
-                    pixels_array = window.flatten()
-                    weighted_values = weights_array * pixels_array
-
-                    outBlockMultiband[band][i, j] = weighted_values.sum() / weights_array.sum()
-
-        pixelBlocks['output_pixels'] = outBlockMultiband.astype(props['pixelType'], copy=False)
+            valid = None if mask is None else mask[band]
+            localStats = LocalStatistics(r[band], valid)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sigma_zero = localStats.variation(self.windowSize) / localStats.mean(self.windowSize)
+            factor_A = self.dampFactor * sigma_zero
+            outBlockMultiband[band] = self.weightedMean(r[band], factor_A, valid)
+
+        pixelBlocks['output_pixels'] = cropPadding(outBlockMultiband, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(mask, self.padding)
         return pixelBlocks
 
+    def weightedMean(self, band, factor_A, mask=None):
+        # Frost weighted mean of every window band[xleft:xright, yup:ydown] (truncated at the block edges),
+        # with weights exp(-factor_A * |window - center_pixel|) and center_pixel = window[N/2, M/2].
+        # Windows are strided views into a zero-padded copy of the band, masked where they fall outside it
+        # or on pixels where mask is 0, and evaluated a chunk of rows at a time so memory stays around
+        # self.chunkSize bytes.
+        row, col = band.shape
+        win_offset = int(self.windowSize/2)
+        size = 2 * win_offset
+        xleft, xright = LocalStatistics.bounds(row, win_offset)
+        yup, ydown = LocalStatistics.bounds(col, win_offset)
+        center_pixel = band[(xleft + (xright - xleft) // 2)[:, None], yup + (ydown - yup) // 2].astype('f8')
+
+        valid = np.ones(band.shape) if mask is None else (np.asarray(mask) != 0).astype('f8')
+        padded = np.pad(np.where(valid > 0, band, 0.0), win_offset, mode='constant')
+        inside = np.pad(valid, win_offset, mode='constant')
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(row, col, size, size), strides=padded.strides * 2)
+        masks = np.lib.stride_tricks.as_strided(inside, shape=(row, col, size, size), strides=inside.strides * 2)
+
+        out = np.empty((row, col))
+        rows = max(1, self.chunkSize // max(1, 3 * 8 * col * size * size))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in xrange(0, row, rows):
+                chunk = slice(i, i + rows)
+                distances = np.abs(windows[chunk] - center_pixel[chunk, :, None, None])
+                weights_array = np.exp(-factor_A[chunk, :, None, None] * distances)
+                weights_array *= masks[chunk]
+                out[chunk] = (weights_array * windows[chunk]).sum((2, 3)) / weights_array.sum((2, 3))
+        return out
+
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
@@ -1,7 +1,7 @@
 from scipy import ndimage
-from skimage.feature import greycomatrix, greycoprops
 import numpy as np
 import math
+from LocalStatistics import LocalStatistics, summedAreaTable, cropPadding, validMask
 
 class GLCM():
 
@@ -24,10 +24,11 @@ class GLCM():
                 'dataType': 'string',
                 'value': "Contrast",
                 'required': True,
-                'domain': ('Contrast', 'Dissimilarity', 'Homogeneity','Angular Second Moment', 'Energy', \
-                           'GLCM Mean', 'GLCM Variance', 'GLCM Correlation'),
                 'displayName': "Output Statistic",
-                'description': "Output Feature of the Raster",
+                'description': "Output Feature of the Raster: Contrast, Dissimilarity, Homogeneity, Angular Second Moment, "
+                               "Energy, GLCM Mean, GLCM Variance or GLCM Correlation. All Features, or a comma separated list "
+                               "of statistics, outputs one band per statistic from a single co-occurrence pass. The output is "
+                               "floating point when Homogeneity, Angular Second Moment, Energy or Correlation is selected.",
             },
             {
                 'name': 'angle',
@@ -36,7 +37,7 @@ class GLCM():
                 'required': True,
                 'domain': ('0', '45', '90','135', 'ALL'),
                 'displayName': "Angle",
-                'description': "",
+                'description': "ALL averages each statistic over the 0, 45, 90 and 135 degree displacements.",
             },
             {
                 'name': 'quantizer',
@@ -45,7 +46,8 @@ class GLCM():
                 'required': True,
                 'domain': ("Probabilistic Quantizer","Equal Distance Quantizer"),
                 'displayName': "Quantizer",
-                'description': "",
+                'description': "Probabilistic Quantizer gives every grey level an equal share of the raster histogram, "
+                               "Equal Distance Quantizer splits the range between the raster minimum and maximum evenly.",
             },
             {
                 'name': 'levels',
@@ -64,17 +66,36 @@ class GLCM():
                 'displayName': "Displacement",
                 'description': "",
             },
+            {
+                'name': 'win',
+                'dataType': 'numeric',
+                'value': 2,
+                'required': False,
+                'displayName': "Moving Window Size",
+                'description': "Enter size of square data window for computation of the co-occurrence statistics. "
+                               "The default of 2 is the window of pixels (i, j) to (i+1, j+1).",
+            },
+            {
+                'name': 'range',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': "Angular Range",
+                'description': "With angle ALL, also output the range (maximum - minimum) of each statistic over the four angles.",
+            },
 
 
         ]
 
 
     def getConfiguration(self, **scalars):
+        self.padding = max(2, int(scalars.get('win', 2))) // 2
+
         return {
           'inheritProperties': 1 | 2 | 4 | 8,   # inherit all properties
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # one extra on each each of the input pixel block
-          'inputMask': False                    # we need the input mask in .updatePixels()
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave pairs on masked pixels (NoData and the fill outside the raster) out of the counts
         }
 
 
@@ -89,13 +110,23 @@ class GLCM():
 
         self.prepare(angle,output,quantizer,levels)
         self.displacement = kwargs.get('dist',1)
+        self.windowSize = max(2, int(kwargs.get('win', 2)))
+        self.angleRange = bool(kwargs.get('range', False)) and len(self.angles) > 1
+        self.bandNames = self.outputs + ([o + '_range' for o in self.outputs] if self.angleRange else [])
 
         stats = kwargs['raster_info']['statistics']
         self.minimum = stats[0].get('minimum',0)      # Minimum pixel value of input raster
         self.maximum = stats[0].get('maximum',255)      # Maximum pixel value of input raster
 
-        kwargs['output_info']['bandCount'] = 1
-        kwargs['output_info']['pixelType'] = 'u2'
+        # quantization lookup table, so every tile is quantized with a single gather
+        histogram = kwargs['raster_info'].get('histogram', ())
+        pixelType = kwargs['raster_info'].get('pixelType', 'f4')
+        self.buildQuantizer(histogram[0] if len(histogram) else None, pixelType[0] in ('u', 'i'))
+
+        kwargs['output_info']['bandCount'] = len(self.bandNames)
+        # correlation is signed and homogeneity, ASM and energy lie in [0, 1], so they need a floating point raster
+        fractional = set(self.outputs) & set(('correlation', 'homogeneity', 'ASM', 'energy'))
+        kwargs['output_info']['pixelType'] = 'f4' if fractional else 'u2'
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
         kwargs['output_info']['colormap'] = ()
@@ -104,33 +135,37 @@ class GLCM():
 
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
-        raster = np.array(pixelBlocks['raster_pixels'], dtype='u1', copy=False)
+        raster = np.asarray(pixelBlocks['raster_pixels'])
         row = raster.shape[1]
         col = raster.shape[2]
-        
-        ## apply linear stretch
-        if self.maximum > 255 or self.minimum < 0:
-            raster = (raster - self.minimum) * ((255)/(self.maximum - self.minimum)) + 0
 
+        ## quantize pixel values to grey levels
         rasterBand = raster.reshape((row,col))
+        mask = pixelBlocks.get('raster_mask')
+        valid = None if mask is None else validMask(mask[0])
+        if valid is not None:
+            rasterBand = np.where(valid, rasterBand, self.minimum)       # masked values, possibly NaN, are not counted
+        index = np.clip((rasterBand - self.minimum) / self.step, 0, self.lut.size - 1).astype(np.intp)
+        quantized = self.lut[index]
 
-        # calculate grey level co-occurence matrix
-        g = np.zeros((row,col),dtype=np.int)
-        for i in xrange(row):
-            for j in xrange(col):
-                glcm_window = rasterBand[i: i+2, j: j+2]                
-                glcm = greycomatrix(glcm_window,[self.displacement],[self.angle],int(self.levels),symmetric = True, normed=True)
-                g[i][j] = greycoprops(glcm, self.output)
-
-        xs = []
-        xs.append(greycoprops(glcm,'energy')[0,0])
-        xs.append(greycoprops(glcm,'correlation')[0,0])
-        xs.append(greycoprops(glcm,'contrast')[0,0])
-        xs.append(greycoprops(glcm,'dissimilarity')[0,0])
+        # calculate grey level co-occurence statistics of every moving window, for each angle,
+        # sharing the summed-area tables of the quantized band between the angles
+        tables = {}
+        cooccurrences = []
+        for angle in self.angles:
+            offset = (int(round(math.sin(angle) * self.displacement)), int(round(math.cos(angle) * self.displacement)))
+            cooccurrences.append(CooccurrenceStatistics(quantized, offset, self.levels, self.windowSize, tables, valid))
 
-        outBlock = g.reshape((1,row,col))
+        outBlock = np.zeros((len(self.bandNames),row,col),dtype='f8')
+        for k, output in enumerate(self.outputs):
+            values = [cooccurrence.feature(output) for cooccurrence in cooccurrences]
+            outBlock[k] = sum(values) / len(values)               # mean over the angles
+            if self.angleRange:
+                outBlock[len(self.outputs) + k] = np.maximum.reduce(values) - np.minimum.reduce(values)
 
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_pixels'] = cropPadding(outBlock, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(np.tile(mask[:1], (len(self.bandNames), 1, 1)), self.padding)
         return pixelBlocks
 
 
@@ -140,24 +175,36 @@ class GLCM():
         elif bandIndex == 0:                            # properties for the first band
             keyMetadata['wavelengthmin'] = None         # reset inapplicable band-specific key metadata
             keyMetadata['wavelengthmax'] = None
-            keyMetadata['bandname'] = 'GLCM'
+            keyMetadata['bandname'] = 'GLCM' if len(self.bandNames) == 1 else self.bandNames[0]
+        elif bandIndex > 0:
+            keyMetadata['bandname'] = self.bandNames[bandIndex]
         return keyMetadata
 
     def prepare(self, angle, output, quantizer, levels):
-        ## assignmnt of angle
-        if (angle == "ALL"):                  self.angle = np.pi
-        elif (angle == "0"):                  self.angle = 0
-        elif (angle == "45"):                 self.angle = np.pi/8
-        elif (angle == "90"):                 self.angle = np.pi/4
-        else:                                 self.angle = np.pi/2
-
-        ## assignment of output statistics
-        if (output == "GLCM Correlation"):        self.output = 'correlation'
-        elif (output == "Contrast"):                self.output = 'contrast'
-        elif (output == "Dissimilarity"):           self.output = 'dissimilarity'
-        elif (output == "Homogeneity"):             self.output = 'homogeneity'
-        elif (output == "Angular Second Moment"):   self.output = 'ASM'
-        else:                                       self.output = 'energy'
+        ## assignmnt of angles, in radians
+        if (angle == "ALL"):                  self.angles = [0, np.pi/4, np.pi/2, 3*np.pi/4]
+        elif (angle == "0"):                  self.angles = [0]
+        elif (angle == "45"):                 self.angles = [np.pi/4]
+        elif (angle == "90"):                 self.angles = [np.pi/2]
+        else:                                 self.angles = [3*np.pi/4]
+
+        ## assignment of output statistics, one output band each
+        if (output == "All Features"):
+            output = "Contrast,Dissimilarity,Homogeneity,Angular Second Moment,Energy,GLCM Mean,GLCM Variance,GLCM Correlation"
+
+        self.outputs = []
+        for statistic in output.split(','):
+            statistic = statistic.strip()
+            if (statistic == "GLCM Correlation"):        self.outputs.append('correlation')
+            elif (statistic == "Contrast"):                self.outputs.append('contrast')
+            elif (statistic == "Dissimilarity"):           self.outputs.append('dissimilarity')
+            elif (statistic == "Homogeneity"):             self.outputs.append('homogeneity')
+            elif (statistic == "Angular Second Moment"):   self.outputs.append('ASM')
+            elif (statistic == "GLCM Mean"):               self.outputs.append('mean')
+            elif (statistic == "GLCM Variance"):           self.outputs.append('variance')
+            elif (statistic == "Energy"):                  self.outputs.append('energy')
+            else:
+                raise Exception("Unknown GLCM statistic '{0}'.".format(statistic))
 
         ## assignment of quantizer
         if (quantizer == "Probabilistic Quantizer"): self.quantizer = 0
@@ -173,6 +220,209 @@ class GLCM():
         elif (levels == "128"):               self.levels = 128
         else:                               self.levels = 256
 
+    def buildQuantizer(self, histogram, integer):
+        # Lookup table from pixel value to grey level. The value range [minimum, maximum] is split into at most
+        # 65536 bins of width self.step (one bin per value for integer rasters that fit), and each bin is mapped
+        # to a level with equal-distance or equal-probability (histogram based) intervals.
+        valueRange = float(self.maximum - self.minimum)
+        if integer and valueRange < 65536:
+            self.step, bins = 1.0, int(valueRange) + 1
+        else:
+            self.step, bins = max(valueRange, 1e-12) / 65535, 65536
+
+        if self.quantizer == 0 and histogram is not None and np.sum(histogram['counts']) > 0:
+            # equal probability: level of a bin is the fraction of pixels below it
+            counts = np.asarray(histogram['counts'], dtype='f8')
+            hmin, hmax = float(histogram['minimum']), float(histogram['maximum'])
+            values = self.minimum + self.step * np.arange(bins)
+            h = np.clip(((values - hmin) * counts.size / max(hmax - hmin, 1e-12)).astype(np.intp), 0, counts.size - 1)
+            below = np.concatenate(([0.0], np.cumsum(counts)[:-1]))[h]
+            self.lut = np.minimum((below * self.levels / counts.sum()).astype(np.intp), self.levels - 1)
+        else:
+            # equal distance (also used when the raster has no histogram)
+            self.lut = np.arange(bins, dtype=np.intp) * self.levels // bins
+
+class CooccurrenceStatistics():
+
+    def __init__(self, quantized, offset, levels, winSize=2, tables=None, mask=None):
+        # Symmetric, normalized grey level co-occurrence statistics of every window of a quantized band, for one
+        # (row, col) displacement, as greycomatrix(window, ..., symmetric=True, normed=True) and greycoprops
+        # would give them. The window of pixel (i, j) starts (winSize-1)/2 rows and columns before it and is
+        # truncated at the block edges, so winSize 2 is rasterBand[i:i+2, j:j+2].
+        # No co-occurrence matrix is built. The features are window sums of functions of the pixel pairs,
+        # and those sums are read from summed-area tables of pair images. Tables of the quantized band alone
+        # are kept in the tables dict, which can be shared by the statistics of other offsets of the same band.
+        # With a boolean mask, only the pairs of two valid pixels are counted.
+        row, col = quantized.shape
+        dr, dc = offset
+        self.levels = levels
+        self.offset = offset
+        self.winSize = winSize
+        self.features = {}
+        self.tables = {} if tables is None else tables
+
+        # anchors p of the pairs (p, p + offset) that lie inside each window
+        start = (winSize - 1) // 2
+        r0, r1 = np.clip(np.arange(row) - start, 0, row), np.clip(np.arange(row) - start + winSize, 0, row)
+        c0, c1 = np.clip(np.arange(col) - start, 0, col), np.clip(np.arange(col) - start + winSize, 0, col)
+        self.ar0, self.ac0 = np.minimum(np.maximum(r0, r0 - dr), r1), np.minimum(np.maximum(c0, c0 - dc), c1)
+        self.ar1, self.ac1 = np.maximum(np.minimum(r1, r1 - dr), self.ar0), np.maximum(np.minimum(c1, c1 - dc), self.ac0)
+        self.pairs = ((self.ar1 - self.ar0)[:, None] * (self.ac1 - self.ac0)).astype('f8')
+
+        # pair images: a = quantized[p], b = quantized[p + offset], zero where p + offset leaves the block
+        self.a = quantized
+        self.b = np.zeros_like(quantized)
+        rows = slice(max(0, -dr), max(0, min(row, row - dr)))
+        cols = slice(max(0, -dc), max(0, min(col, col - dc)))
+        self.b[rows, cols] = quantized[rows.start + dr:rows.stop + dr, cols.start + dc:cols.stop + dc]
+        self.fa = self.a.astype('f8')
+        self.fb = self.b.astype('f8')
+        self.sums = None
+
+        # valid pairs: 1 where both quantized[p] and quantized[p + offset] are valid, None when all are
+        self.valid = None
+        if mask is not None:
+            self.valid = np.zeros(quantized.shape)
+            self.valid[rows, cols] = mask[rows, cols] & mask[rows.start + dr:rows.stop + dr, cols.start + dc:cols.stop + dc]
+            self.pairs = self.windowSum(self.valid)
+
+    def windowSum(self, image, dr=0, dc=0):
+        # sum of image over the anchors p of every window, restricted to anchors with p + (dr, dc) also in the window
+        ar0, ar1 = np.minimum(np.maximum(self.ar0, self.ar0 - dr), self.ar1), np.minimum(self.ar1, self.ar1 - dr)
+        ac0, ac1 = np.minimum(np.maximum(self.ac0, self.ac0 - dc), self.ac1), np.minimum(self.ac1, self.ac1 - dc)
+        ar1, ac1 = np.maximum(ar1, ar0), np.maximum(ac1, ac0)
+        return LocalStatistics.boxSum(summedAreaTable(image), ar0, ar1, ac0, ac1)
+
+    def pairSum(self, image):
+        # window sum of image over the valid pairs
+        return self.windowSum(image if self.valid is None else image * self.valid)
+
+    def marginalSum(self, power):
+        # window sum of a^power + b^power: both are the quantized band, at the anchors and at the anchors + offset
+        if self.valid is not None:
+            return self.pairSum(np.power(self.fa, power) + np.power(self.fb, power))
+        if power not in self.tables:
+            self.tables[power] = summedAreaTable(np.power(self.fa, power))
+        dr, dc = self.offset
+        row, col = self.a.shape
+        return (LocalStatistics.boxSum(self.tables[power], self.ar0, self.ar1, self.ac0, self.ac1) +
+                LocalStatistics.boxSum(self.tables[power], np.clip(self.ar0 + dr, 0, row), np.clip(self.ar1 + dr, 0, row),
+                                       np.clip(self.ac0 + dc, 0, col), np.clip(self.ac1 + dc, 0, col)))
+
+    def squaredCounts(self):
+        # small windows compare pairs one anchor displacement at a time, larger ones slide a histogram
+        if self.winSize <= 3:
+            return self.displacedSquaredCounts()
+        return self.slidingSquaredCounts()
+
+    def displacedSquaredCounts(self):
+        # sum over the co-occurrence matrix entries of count^2: every ordered couple of pairs (p, q) of a window
+        # adds 2 * ([ab_p == ab_q] + [ab_p == ba_q]), collected one anchor displacement (dr, dc) at a time
+        row, col = self.a.shape
+        pair = self.a * self.levels + self.b
+        reverse = self.b * self.levels + self.a
+        height = int((self.ar1 - self.ar0).max()) if row else 0
+        width = int((self.ac1 - self.ac0).max()) if col else 0
+
+        total = np.zeros(self.pairs.shape)
+        for dr in xrange(1 - height, height):
+            for dc in xrange(1 - width, width):
+                equal = np.zeros(self.a.shape)
+                rows = slice(max(0, -dr), max(0, min(row, row - dr)))
+                cols = slice(max(0, -dc), max(0, min(col, col - dc)))
+                shifted = (slice(rows.start + dr, rows.stop + dr), slice(cols.start + dc, cols.stop + dc))
+                equal[rows, cols] = (pair[rows, cols] == pair[shifted]) + 1.0 * (pair[rows, cols] == reverse[shifted])
+                if self.valid is not None:
+                    equal[rows, cols] *= self.valid[rows, cols] * self.valid[shifted]
+                total += self.windowSum(equal, dr, dc)
+        return 2.0 * total
+
+    def slidingSquaredCounts(self, maxElements=1 << 24):
+        # sum over the co-occurrence matrix entries of count^2, from one sliding co-occurrence histogram per output
+        # row. Moving a window right adds the pairs anchored in the entering column and removes those of the leaving
+        # column, so each step costs O(window height) and the sum of squares is updated with every count change.
+        # Rows are processed in strips to keep the histograms to about maxElements counts.
+        row, col = self.a.shape
+        bins = self.levels * self.levels
+        pair = self.a * self.levels + self.b
+        reverse = self.b * self.levels + self.a
+        height = int((self.ar1 - self.ar0).max()) if row else 0
+        stripHeight = max(1, maxElements // bins)
+
+        total = np.zeros((row, col))
+        for s0 in xrange(0, row, stripHeight):
+            rows = np.arange(s0, min(s0 + stripHeight, row))
+            hist = np.zeros(rows.size * bins, dtype=np.int32)
+            base = np.arange(rows.size) * bins
+            squares = np.zeros(rows.size)
+
+            def update(c, sign):
+                # add (sign = 1) or remove (sign = -1) the symmetric pairs anchored in column c of every window
+                for k in xrange(height):
+                    anchor = self.ar0[rows] + k
+                    inside = np.nonzero(anchor < self.ar1[rows])[0]
+                    if self.valid is not None:
+                        inside = inside[self.valid[anchor[inside], c] > 0]
+                    for codes in (pair, reverse):
+                        index = base[inside] + codes[anchor[inside], c]
+                        count = hist[index]
+                        squares[inside] += sign * (2 * count + sign)
+                        hist[index] = count + sign
+
+            lo = hi = 0
+            for j in xrange(col):
+                while hi < self.ac1[j]:
+                    update(hi, 1)
+                    hi += 1
+                while lo < self.ac0[j]:
+                    update(lo, -1)
+                    lo += 1
+                total[rows, j] = squares
+        return total
+
+    def varianceSums(self):
+        # N^2 times the covariance and variance of the GLCM marginals, with N = 2n symmetric entries:
+        # cov = (N*Sab - S1^2) / N^2 and var = (N*S2 - S1^2) / N^2, exact in integers
+        if self.sums is None:
+            s1 = self.marginalSum(1)
+            s2 = self.marginalSum(2)
+            sab = self.pairSum(2.0 * self.fa * self.fb)
+            self.sums = (2.0 * self.pairs * sab - s1 * s1, 2.0 * self.pairs * s2 - s1 * s1)
+        return self.sums
+
+    def feature(self, name):
+        if name in self.features:
+            return self.features[name]
+
+        a, b = self.fa, self.fb
+        n = self.pairs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if name == 'contrast':
+                value = self.pairSum(np.square(a - b)) / n
+            elif name == 'dissimilarity':
+                value = self.pairSum(np.abs(a - b)) / n
+            elif name == 'homogeneity':
+                # the only non-integer pair image: round off the summed-area noise so that exact sums stay exact
+                value = np.round(self.pairSum(1.0 / (1.0 + np.square(a - b))), 9) / n
+            elif name == 'ASM':
+                value = self.squaredCounts() / np.square(2.0 * n)
+            elif name == 'energy':
+                value = np.sqrt(self.feature('ASM'))
+            elif name == 'mean':
+                value = self.marginalSum(1) / (2.0 * n)
+            elif name == 'variance':
+                value = self.varianceSums()[1] / np.square(2.0 * n)
+            elif name == 'correlation':
+                # flat windows (var = 0) are found exactly and given 1 like greycoprops
+                cov, var = self.varianceSums()
+                value = np.where(var > 0, cov / var, 1.0)
+            else:
+                raise Exception("Unknown GLCM property '{0}'.".format(name))
+        if name != 'correlation':
+            value[n == 0] = 0.0                     # an empty matrix has all-zero properties
+        self.features[name] = value
+        return value
+
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 """
 References:
@@ -1,5 +1,8 @@
+import math
 import numpy as np
-from skimage.filters import gabor
+from scipy import ndimage as ndi
+from skimage.filters import gabor_kernel
+from scipy.fftpack import next_fast_len
 
 class GaborFilter():
 
@@ -19,11 +22,12 @@ class GaborFilter():
             },
             {
                 'name': 'theta',
-                'dataType': 'numeric',
-                'value': 0.0,
+                'dataType': 'string',
+                'value': "0.0",
                 'required': True,
                 'displayName': "Theta Value",
-                'description': "Orientation of the normal to the parallel stripes of a Gabor function."
+                'description': "Orientation of the normal to the parallel stripes of a Gabor function. "
+                               "Enter a comma separated list of values for a filter bank."
             },
             {
                 'name': 'psi',
@@ -35,11 +39,12 @@ class GaborFilter():
             },
             {
                 'name': 'frequency',
-                'dataType': 'numeric',
-                'value': 0.1,
+                'dataType': 'string',
+                'value': "0.1",
                 'required': True,
                 'displayName': "Frequency",
-                'description': "Spatial frequency of the harmonic function. Specified in pixels."
+                'description': "Spatial frequency of the harmonic function. Specified in pixels. "
+                               "Enter a comma separated list of values for a filter bank."
             },
             {
                 'name': 'sigma',
@@ -65,6 +70,26 @@ class GaborFilter():
                 'displayName': "Number of standard Deviations",
                 'description': "The linear size of the kernel."
             },
+            {
+                'name': 'tolerance',
+                'dataType': 'numeric',
+                'value': 0.0,
+                'required': False,
+                'displayName': "Separable Tolerance",
+                'description': "Relative error allowed when a kernel is approximated by a sum of separable (row x column) kernels. "
+                               "0 only uses exactly separable kernels, such as theta 0 or 90 degrees."
+            },
+            {
+                'name': 'output',
+                'dataType': 'string',
+                'value': "Real",
+                'required': False,
+                'domain': ('Real', 'Imaginary', 'Magnitude', 'Phase'),
+                'displayName': "Output Response",
+                'description': "Part of the complex filter response to output. Magnitude is the texture energy "
+                               "sqrt(real^2 + imaginary^2), Phase is in radians. Imaginary and Phase are signed, so they "
+                               "are output as floating point."
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -76,17 +101,34 @@ class GaborFilter():
         }
 
     def updateRasterInfo(self, **kwargs):
-        self.theta = kwargs.get('theta', 0.0)
-        self.frequency = kwargs.get('frequency', 0.1)
+        self.thetas = [float(v) for v in str(kwargs.get('theta', 0.0)).split(',')]
+        self.frequencies = [float(v) for v in str(kwargs.get('frequency', 0.1)).split(',')]
         self.psi   = kwargs.get('psi', 0.0)
         self.sigma = kwargs.get('sigma', 2.0)
         self.gamma = kwargs.get('gamma', 0.5)
         self.n_stds = kwargs.get('n_stds', 3)
+        self.output = kwargs.get('output', 'Real')
+        self.parts = (self.output != 'Imaginary', self.output != 'Real')     # real and imaginary response needed
 
         self.bandCount = kwargs['raster_info']['bandCount']
 
-        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount']
-        kwargs['output_info']['pixelType'] = 'u2'
+        #CREATE GABOR KERNELS, once for every tile
+        sigma_x = self.sigma
+        sigma_y = self.sigma / self.gamma
+
+        self.kernels = []
+        self.kernelNames = []
+        for theta in self.thetas:
+            for frequency in self.frequencies:
+                self.kernels.append(gabor_kernel(frequency, theta, 1, sigma_x, sigma_y, self.n_stds, self.psi))
+                self.kernelNames.append("Gabor_{0:g}_{1:g}".format(theta, frequency))
+        self.radius = max(max(k.shape) // 2 for k in self.kernels)
+        self.tolerance = float(kwargs.get('tolerance', 0.0))
+        self.factors = [[self.lowRank(part(kernel)) for part in (np.real, np.imag)] for kernel in self.kernels]
+        self.spectra = {}                               # kernel part transforms, by transform shape
+
+        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount'] * len(self.kernels)
+        kwargs['output_info']['pixelType'] = 'f4' if self.output in ('Imaginary', 'Phase') else 'u2'
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
         kwargs['output_info']['colormap'] = ()
@@ -99,22 +141,85 @@ class GaborFilter():
         row = raster.shape[1]
         col = raster.shape[2]
 
-        #CREATE GABOR KERNEL
-        sigma_x = self.sigma
-        sigma_y = self.sigma / self.gamma
-
-        outBlockMultiband = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False)
+        outBlockMultiband = np.zeros((self.bandCount * len(self.kernels), row, col), dtype='f4')
         for band in xrange(self.bandCount):
-            gReal, gImag = gabor(raster[band], self.frequency, self.theta, 1, sigma_x, sigma_y,self.n_stds, self.psi, mode='reflect', cval=0)
-            outBlockMultiband[band] = gReal
+            for k, (gReal, gImag) in enumerate(self.convolveBank(raster[band])):
+                out = outBlockMultiband[k * self.bandCount + band]
+                if self.output == 'Real':
+                    out[:] = gReal
+                elif self.output == 'Imaginary':
+                    out[:] = gImag
+                elif self.output == 'Magnitude':
+                    # sqrt(gReal^2 + gImag^2), accumulated in place in the float32 output band
+                    np.square(gReal, out=out)
+                    gImag *= gImag
+                    out += gImag
+                    np.sqrt(out, out=out)
+                else:
+                    np.arctan2(gImag, gReal, out=out)
         pixelBlocks['output_pixels'] = outBlockMultiband.astype(props['pixelType'], copy=False)
 
         return pixelBlocks
 
 
+    def lowRank(self, kernel):
+        # column and row factors (u_k, v_k) of the lowest rank approximation sum_k outer(u_k, v_k) of a real kernel
+        # whose relative error is within self.tolerance. An exactly separable kernel has a single pair.
+        u, s, vt = np.linalg.svd(kernel)
+        residual = np.sqrt(np.cumsum(np.square(s[::-1])))[::-1]      # residual[k]: error of the rank k approximation
+        rank = np.count_nonzero(residual > max(self.tolerance, 1e-7) * residual[0]) if s.size and s[0] > 0 else 0
+        return [(u[:, k] * s[k], vt[k]) for k in xrange(rank)]
+
+    def convolveBank(self, band):
+        # Convolve one band with every kernel of the bank, as ndimage.convolve(band, kernel, mode='reflect') would,
+        # yielding the (real, imaginary) response of each kernel, with None for a part that self.parts leaves out.
+        # A kernel part of low rank r is applied as r pairs of 1-D convolutions, O(r * (height + width)) per pixel,
+        # when that is cheaper than the transforms it would otherwise need, about O(log(pixels)) per pixel each.
+        # Otherwise the band is reflected by the largest kernel radius and transformed once, and every kernel
+        # costs one spectrum product and one inverse transform. The circular wrap-around only reaches the first
+        # 2 * radius rows and columns of the result, which lie in the reflected border and are cropped.
+        row, col = band.shape
+        band = band.astype('f8')
+        shape = (next_fast_len(row + 2 * self.radius), next_fast_len(col + 2 * self.radius))
+
+        # Timed on 256^2 to 1024^2 blocks, the spectrum product, inverse transform and crop cost about as much as
+        # 2 * log2(pixels) taps of 1-D convolution, and padding and transforming the band about 2.5 * log2(pixels).
+        # The band transform is paid only when no other kernel part transforms the band anyway, so a single
+        # rank-1 kernel stays on the 1-D path up to about 80 taps (sigma 4 on 512^2), and kernels of a larger
+        # bank move to the transform sooner. Kernel spectra are cached for every block and not counted.
+        log2Pixels = math.log(shape[0] * shape[1], 2)
+        def fftCost(k, p, bandReady):
+            return 2 * log2Pixels + (0 if bandReady else 2.5 * log2Pixels)
+        taps = [[len(factors) * sum(kernel.shape) for factors in self.factors[k]] for k, kernel in enumerate(self.kernels)]
+        bandReady = any(needed and taps[k][p] > fftCost(k, p, False)
+                        for k in xrange(len(self.kernels)) for p, needed in enumerate(self.parts))
+        bandSpectrum = None
+
+        for k, kernel in enumerate(self.kernels):
+            responses = []
+            for p, (part, needed) in enumerate(zip((np.real, np.imag), self.parts)):
+                factors = self.factors[k][p]
+                if not needed:
+                    responses.append(None)
+                elif taps[k][p] <= fftCost(k, p, bandReady or bandSpectrum is not None):
+                    response = np.zeros((row, col))
+                    for u, v in factors:
+                        response += ndi.convolve1d(ndi.convolve1d(band, u, 0, mode='reflect'), v, 1, mode='reflect')
+                    responses.append(response)
+                else:
+                    if bandSpectrum is None:
+                        bandSpectrum = np.fft.rfft2(np.pad(band, self.radius, mode='symmetric'), shape)
+                    if (shape, k, p) not in self.spectra:
+                        self.spectra[(shape, k, p)] = np.fft.rfft2(part(kernel), shape)
+                    r0, c0 = self.radius + kernel.shape[0] // 2, self.radius + kernel.shape[1] // 2
+                    responses.append(np.fft.irfft2(bandSpectrum * self.spectra[(shape, k, p)], shape)[r0:r0 + row, c0:c0 + col])
+            yield tuple(responses)
+
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
+        elif len(self.kernels) > 1:                     # name the output bands of each kernel
+            keyMetadata['bandname'] = "{0}_{1}".format(self.kernelNames[bandIndex // self.bandCount], bandIndex % self.bandCount + 1)
         return keyMetadata
 
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
@@ -1,6 +1,10 @@
 import numpy as np
 from scipy import signal
 import math
+from LocalStatistics import LocalStatistics, cropPadding
+
+# relative magnitude gap under which the root np.roots lists first is not reliably the largest
+rootTieTolerance = 0.2
 
 class GammaFilter():
 
@@ -30,11 +34,14 @@ class GammaFilter():
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties':  4 | 8,              # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,        # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                             # no padding of the input pixel block
-          'inputMask': False                        # we don't need the input mask in .updatePixels()
+          'padding': self.padding,                  # pad the input pixel block by half the window size.
+          'inputMask': True                         # leave masked pixels (NoData and the fill outside the raster) out of the windows
         }
 
     def updateRasterInfo(self, **kwargs):
@@ -54,37 +61,72 @@ class GammaFilter():
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
         r = np.array(pixelBlocks['raster_pixels'], dtype ='f4', copy=False)
         outBlock = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False)
-        row = r.shape[1]
-        col = r.shape[2]
-        win_offset = int(self.windowSize/2)
+        mask = pixelBlocks.get('raster_mask')
 
         for band in xrange(self.bandCount):
-            for i in xrange(row):
-                xleft = i - win_offset
-                xright = i + win_offset
-                if xleft < 0:
-                    xleft = 0
-                if xright >= row:
-                    xright = row
-                for j in xrange(col):
-                    yup = j - win_offset
-                    ydown = j + win_offset
-                    if yup < 0:
-                        yup = 0
-                    if ydown >= col:
-                        ydown = col
-
-                    pix_value = r[band][i, j]
-                    window = r[band][xleft:xright, yup:ydown]
-                    window_mean = np.mean(window)
-                    window_std = np.std(window)
-
-                    new_pix_value = np.real(np.roots([1,-window_mean,window_std*window_std,(window_std * pix_value * window_std)]))
-                    outBlock[band][i, j] = np.round(new_pix_value[0])
-
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+            localStats = LocalStatistics(r[band], None if mask is None else mask[band])
+            window_mean = localStats.mean(self.windowSize)
+            window_var = localStats.variance(self.windowSize)
+
+            # Gamma MAP estimate: root of x^3 - mean*x^2 + var*x + var*pix = 0
+            new_pix_value = self.cubicRoot(-window_mean, window_var, window_var * r[band])
+            outBlock[band] = np.round(new_pix_value)
+
+        pixelBlocks['output_pixels'] = cropPadding(outBlock, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(mask, self.padding)
         return pixelBlocks
 
+    def cubicRoot(self, a, b, c):
+        # np.real(np.roots([1, a, b, c]))[0] of the per-pixel solver, element-wise.
+        # np.roots usually lists the largest-magnitude root first, so that root comes from Cardano's formula
+        # on the depressed cubic t^3 + p*t + q = 0, with x = t - a/3. When another root is within
+        # rootTieTolerance of that magnitude its order is not reliable, and those pixels are solved as np.roots does.
+        a, b, c = np.broadcast_arrays(np.asarray(a, 'f8'), np.asarray(b, 'f8'), np.asarray(c, 'f8'))
+        p = b - a * a / 3.0
+        q = (2.0 * a * a * a - 9.0 * a * b) / 27.0 + c
+
+        # pick the sign of the square root that keeps |u^3| large, so v = -p/(3u) is well conditioned
+        sqrtD = np.sqrt((q * q / 4.0 + p * p * p / 27.0).astype(np.complex128))
+        sqrtD = np.where(np.real(np.conj(sqrtD) * q) < 0, sqrtD, -sqrtD)
+        u = np.power(-q / 2.0 + sqrtD, 1.0 / 3.0)
+        degenerate = u == 0
+        u = np.where(degenerate, 1.0, u)
+
+        roots = []
+        for k in xrange(3):
+            uk = u * np.exp(2j * np.pi * k / 3.0)
+            t = np.where(degenerate, 0.0, uk - p / (3.0 * uk))
+            roots.append(t - a / 3.0)
+        roots = np.array(roots)
+
+        magnitude = np.abs(roots)
+        largest = magnitude.argmax(0)
+        result = np.real(np.choose(largest, roots))
+
+        tie = (magnitude.max(0) - magnitude <= rootTieTolerance * magnitude.max(0)) & \
+              (np.abs(np.real(roots) - result) > 1e-9 * np.maximum(1.0, np.abs(result)))
+        tie = tie.any(0)
+        if tie.any():
+            result[tie] = self.companionRoot(a[tie], b[tie], c[tie])
+        return result
+
+    def companionRoot(self, a, b, c):
+        # first eigenvalue of the companion matrix, as np.roots computes it, with trailing zero coefficients dropped
+        result = -a.copy()                              # x^2 * (x + a) = 0
+        cubic = c != 0
+        quadratic = ~cubic & (b != 0)
+
+        companion = np.zeros((cubic.sum(), 3, 3))
+        companion[:, 0] = -np.column_stack((a[cubic], b[cubic], c[cubic]))
+        companion[:, 1, 0] = companion[:, 2, 1] = 1.0
+        result[cubic] = np.real(np.linalg.eigvals(companion)[:, 0])
+
+        companion = np.zeros((quadratic.sum(), 2, 2))
+        companion[:, 0] = -np.column_stack((a[quadratic], b[quadratic]))
+        companion[:, 1, 0] = 1.0
+        result[quadratic] = np.real(np.linalg.eigvals(companion)[:, 0])
+        return result
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
@@ -4,6 +4,8 @@ from scipy import ndimage as ndi, stats
 from scipy.signal import medfilt
 from scipy.stats import variation
 from numpy import ndarray
+from LocalStatistics import cropPadding
+from AdaptiveSpeckle import AdaptiveSpeckle
 
 class KuanFilter():
 
@@ -33,11 +35,14 @@ class KuanFilter():
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties': 4 | 8,           # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # no padding to the input pixel block.
-          'inputMask': False                    # input mask in .updatePixels() not required.
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave masked pixels (NoData and the fill outside the raster) out of the windows
          }
 
     def updateRasterInfo(self, **kwargs):
@@ -57,48 +62,17 @@ class KuanFilter():
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
+        mask = pixelBlocks.get('raster_mask')
         cu = np.float(0.25)
-        row = r.shape[1]
-        col = r.shape[2]
-        win_offset = int(self.windowSize/2)
         outBlockMultiband = np.zeros_like(r)
 
         for band in xrange(self.bandCount):
-            for i in xrange(row):
-                xleft = i - win_offset
-                xright = i + win_offset
-                if xleft < 0:
-                    xleft = 0
-                if xright >= row:
-                    xright = row
-                for j in xrange(col):
-                    yup = j - win_offset
-                    ydown = j + win_offset
-                    if yup < 0:
-                        yup = 0
-                    if ydown >= col:
-                        ydown = col
-
-                    pix_value = r[band][i, j]
-                    window = r[band][xleft:xright, yup:ydown]
-
-                    two_cu = cu * cu
-                    ci = np.std(window)/np.mean(window)
-                    two_ci = ci * ci
-                    if not two_ci:
-                        two_ci = 0.1
-                    divisor = 1.0 + two_cu
-                    if cu > ci:
-                        w_t = 0.0
-                    else:
-                        w_t = (1.0 - (two_cu / two_ci)) / divisor
-
-                    window_mean = window.mean()
-                    new_pix_value = (pix_value * w_t) + (window_mean * (1.0 - w_t))
-
-                    outBlockMultiband[band][i, j] = np.round(new_pix_value)
+            speckle = AdaptiveSpeckle(r[band], self.windowSize, cu, None if mask is None else mask[band])
+            outBlockMultiband[band] = np.round(speckle.filter('Kuan'))
 
-        pixelBlocks['output_pixels'] = outBlockMultiband.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_pixels'] = cropPadding(outBlockMultiband, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(mask, self.padding)
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
@@ -4,6 +4,8 @@ from scipy import ndimage as ndi, stats
 from scipy.signal import medfilt
 from scipy.stats import variation
 from numpy import ndarray
+from LocalStatistics import cropPadding
+from AdaptiveSpeckle import AdaptiveSpeckle
 
 class LeeFilter():
 
@@ -30,14 +32,35 @@ class LeeFilter():
                 'description': "Enter size of square data window for computation of local mean and deviation."
                                "Must be an odd number. If you enter an even number, function automatically adds one (+1) to make the number odd."
             },
+            {
+                'name': 'mode',
+                'dataType': 'string',
+                'value': 'Lee',
+                'required': False,
+                'domain': ('Lee', 'Kuan', 'Enhanced Lee', 'All'),
+                'displayName': "Weighting",
+                'description': "Weighting of the pixel value against the local mean. All outputs the Lee, Kuan and Enhanced Lee results "
+                               "of every band, in that order, from a single pass over the local statistics."
+            },
+            {
+                'name': 'damp',
+                'dataType': 'numeric',
+                'value': 1.0,
+                'required': False,
+                'displayName': "Damping Factor",
+                'description': "Amount of exponential damping used by the Enhanced Lee weighting."
+            },
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties': 4 | 8,           # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # no padding to the input pixel block.
-          'inputMask': False                    # input mask in .updatePixels() not required.
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave masked pixels (NoData and the fill outside the raster) out of the windows
          }
 
     def updateRasterInfo(self, **kwargs):
@@ -45,10 +68,14 @@ class LeeFilter():
         windowSizeTemp = kwargs['win'] 
         self.windowSize = windowSizeTemp if (windowSizeTemp % 2 != 0) else windowSizeTemp + 1
 
+        mode = kwargs.get('mode', 'Lee')
+        self.modes = ('Lee', 'Kuan', 'Enhanced Lee') if mode == 'All' else (mode,)
+        self.dampFactor = float(kwargs.get('damp', 1.0))
+
         self.bandCount = kwargs['raster_info']['bandCount']
                 
         # output raster information
-        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount']
+        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount'] * len(self.modes)
         kwargs['output_info']['pixelType'] = 'u2'
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
@@ -57,52 +84,25 @@ class LeeFilter():
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
+        mask = pixelBlocks.get('raster_mask')
         cu = np.float(0.25)
-        row = r.shape[1]
-        col = r.shape[2]
-        win_offset = int(self.windowSize/2)
-        outBlockMultiband = np.zeros_like(r)
+        outBlockMultiband = np.zeros((len(self.modes) * self.bandCount,) + r.shape[1:], dtype=r.dtype)
 
         for band in xrange(self.bandCount):
-            for i in xrange(row):
-                xleft = i - win_offset
-                xright = i + win_offset
-                if xleft < 0:
-                    xleft = 0
-                if xright >= row:
-                    xright = row
-                for j in xrange(col):
-                    yup = j - win_offset 
-                    ydown = j + win_offset
-                    if yup < 0:
-                        yup = 0
-                    if ydown >= col:
-                        ydown = col
-
-                    pix_value = r[band][i, j]
-                    window = r[band][xleft:xright, yup:ydown]
-
-                    two_cu = cu * cu
-                    ci = np.std(window)/np.mean(window)
-                    two_ci = ci * ci
-                    if not two_ci:
-                        two_ci = 0.1
-                    if cu > ci:
-                        w_t = 0.0
-                    else:
-                        w_t = 1.0 - (two_cu / two_ci)
-
-                    window_mean = window.mean()
-                    new_pix_value = (pix_value * w_t) + (window_mean * (1.0 - w_t))
-
-                    outBlockMultiband[band][i, j] = np.round(new_pix_value)
+            speckle = AdaptiveSpeckle(r[band], self.windowSize, cu, None if mask is None else mask[band])
+            for m, mode in enumerate(self.modes):
+                outBlockMultiband[m * self.bandCount + band] = np.round(speckle.filter(mode, self.dampFactor))
 
-        pixelBlocks['output_pixels'] = outBlockMultiband.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_pixels'] = cropPadding(outBlockMultiband, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(np.tile(mask, (len(self.modes), 1, 1)), self.padding)
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
+        elif len(self.modes) > 1:                       # name the output bands of each weighting
+            keyMetadata['bandname'] = "{0}_{1}".format(self.modes[bandIndex // self.bandCount], bandIndex % self.bandCount + 1)
         return keyMetadata
 
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
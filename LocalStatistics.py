@@ -0,0 +1,135 @@
+import math
+import numpy as np
+from scipy import ndimage as ndi
+
+class LocalStatistics():
+
+    def __init__(self, band, mask=None):
+        # summed-area tables of x and x*x for a single band, built once and shared by every window size.
+        # x*x is shifted by the band mean to limit cancellation when the variance is recovered.
+        # With a mask, pixels where it is 0 (NoData, or the fill padded outside the raster) are left out
+        # of every window, and the window counts come from a summed-area table of the mask.
+        band = np.asarray(band)
+        self.row, self.col = band.shape
+        self.valid = validMask(mask)
+        x = band.astype('f8')
+        if self.valid is not None:
+            x = np.where(self.valid, x, 0.0)
+            self.satCount = summedAreaTable(self.valid.astype('f8'))
+        valid = x if self.valid is None else x[self.valid]
+        self.shift = valid.mean() if valid.size else 0.0
+
+        self.sat = summedAreaTable(x)
+        squares = np.square(x - self.shift)
+        if self.valid is not None:
+            squares[~self.valid] = 0.0
+        self.sat2 = summedAreaTable(squares)
+        self.windows = {}
+
+    def window(self, windowSize):
+        # count, mean and variance of every window band[xleft:xright, yup:ydown] with
+        # xleft = i - windowSize/2 and xright = i + windowSize/2, truncated at the block edges.
+        # This is the window the filters have always sliced out of the pixel block.
+        if windowSize not in self.windows:
+            win_offset = int(windowSize/2)
+            xleft, xright = self.bounds(self.row, win_offset)
+            yup, ydown = self.bounds(self.col, win_offset)
+
+            if self.valid is None:
+                count = ((xright - xleft)[:, None] * (ydown - yup)).astype('f8')
+            else:
+                count = self.boxSum(self.satCount, xleft, xright, yup, ydown)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = self.boxSum(self.sat, xleft, xright, yup, ydown) / count
+                variance = self.boxSum(self.sat2, xleft, xright, yup, ydown) / count - np.square(mean - self.shift)
+            self.windows[windowSize] = (count, mean, np.maximum(variance, 0.0))
+        return self.windows[windowSize]
+
+    def count(self, windowSize):
+        return self.window(windowSize)[0]
+
+    def mean(self, windowSize):
+        return self.window(windowSize)[1]
+
+    def variance(self, windowSize):
+        return self.window(windowSize)[2]
+
+    def std(self, windowSize):
+        return np.sqrt(self.variance(windowSize))
+
+    def variation(self, windowSize):
+        # coefficient of variation, same as scipy.stats.variation(window, None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.std(windowSize) / self.mean(windowSize)
+
+    @staticmethod
+    def bounds(length, win_offset):
+        index = np.arange(length)
+        return np.clip(index - win_offset, 0, length), np.clip(index + win_offset, 0, length)
+
+    @staticmethod
+    def boxSum(sat, xleft, xright, yup, ydown):
+        return (sat[xright[:, None], ydown] - sat[xleft[:, None], ydown]
+                - sat[xright[:, None], yup] + sat[xleft[:, None], yup])
+
+def summedAreaTable(x):
+    # sat[i, j] = x[:i, :j].sum(), with a leading row and column of zeros
+    sat = np.zeros((x.shape[0] + 1, x.shape[1] + 1))
+    sat[1:, 1:] = x.cumsum(0).cumsum(1)
+    return sat
+
+def centralMoments(band, windowSize, order=2, mask=None):
+    # local mean and central moments m2..m<order> of a centred windowSize x windowSize window, reflected
+    # at the block edges as in ndimage.generic_filter. Raw moments E[x^k] come from one uniform_filter pass
+    # each, on the band shifted by its mean to limit cancellation, and are expanded binomially.
+    # With a mask, pixels where it is 0 are left out and every raw moment is divided by the window's share
+    # of valid pixels; windows without any are NaN.
+    x = np.asarray(band, dtype='f8')
+    valid = validMask(mask)
+    if valid is not None:
+        shift = x[valid].mean() if valid.any() else 0.0
+        x = np.where(valid, x - shift, 0.0)
+        share = ndi.uniform_filter(valid.astype('f8'), windowSize)
+        share[share < 0.5 / (windowSize * windowSize)] = np.nan     # no valid pixel, up to rounding
+    else:
+        shift = x.mean() if x.size else 0.0
+        x = x - shift
+        share = 1.0
+
+    raw = [None, ndi.uniform_filter(x, windowSize) / share]
+    xk = x
+    for k in xrange(2, order + 1):
+        xk = xk * x
+        raw.append(ndi.uniform_filter(xk, windowSize) / share)
+
+    mean = raw[1]
+    moments = {}
+    for k in xrange(2, order + 1):
+        m = (1 - k) * (-mean) ** k                  # j = 0 and j = 1 terms, E[x - shift] being the mean
+        for j in xrange(2, k + 1):
+            m = m + (math.factorial(k) // (math.factorial(j) * math.factorial(k - j))) * raw[j] * (-mean) ** (k - j)
+        moments[k] = m
+    if order >= 2:
+        moments[2] = np.maximum(moments[2], 0.0)
+    return mean + shift, moments
+
+def validMask(mask):
+    # boolean mask of valid pixels, or None when there is no mask or every pixel is valid
+    if mask is None:
+        return None
+    mask = np.asarray(mask) != 0
+    return None if mask.all() else mask
+
+def cropPadding(pixelBlock, padding):
+    # strip the padding requested in getConfiguration from the last two (row, col) axes of a pixel block
+    if padding <= 0:
+        return pixelBlock
+    return pixelBlock[..., padding:-padding, padding:-padding]
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+"""
+References:
+    [1]. Wikipedia: Summed-area table.
+    https://en.wikipedia.org/wiki/Summed-area_table
+"""
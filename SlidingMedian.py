@@ -0,0 +1,175 @@
+import math
+import numpy as np
+from scipy import ndimage as ndi
+from LocalStatistics import LocalStatistics, summedAreaTable, validMask
+
+def slidingMedian(band, windowSize, maxBins=1 << 24, mask=None):
+    # median of every window band[xleft:xright, yup:ydown], truncated at the block edges, over the
+    # pixels where mask is not 0. Integer bands up to 16 bits go through the running histogram when
+    # it is the cheaper path, everything else through ndimage.
+    band = np.asarray(band)
+    mask = validMask(mask)
+    if band.dtype.kind in 'ui' and band.size and int(band.max()) - int(band.min()) < 65536:
+        # measured per pixel costs, in units of one rank filter comparison: the rank filter sorts size^2
+        # values, the histogram pays for its bin width and a window row update that grows with it
+        size = 2 * int(windowSize/2)
+        binWidth = math.ceil(math.sqrt(int(band.max()) - int(band.min()) + 1))
+        if size * size >= 20 + binWidth / 2.0 + 4 * size * (binWidth / 16.0) ** 0.3:
+            return histogramMedian(band, windowSize, maxBins, mask)
+    return rankFilterMedian(band, windowSize, mask)
+
+def histogramMedian(band, windowSize, maxBins=1 << 24, mask=None):
+    # Huang's running histogram with the two-level (coarse/fine) layout of Perreault and Hebert.
+    # One histogram is kept per output column of a strip. Moving down a row adds the entering row
+    # and removes the leaving row, and the median is found with a coarse and a fine cumulative sum.
+    # Pixels where mask is False are never added, and windows without any valid pixel are NaN.
+    row, col = band.shape
+    win_offset = int(windowSize/2)
+    xleft, xright = LocalStatistics.bounds(row, win_offset)
+    yup, ydown = LocalStatistics.bounds(col, win_offset)
+
+    if mask is not None:
+        counts = LocalStatistics.boxSum(summedAreaTable(mask.astype('f8')), xleft, xright, yup, ydown).astype(np.intp)
+        band = np.where(mask, band, band[mask].min() if mask.any() else 0)
+    vmin = int(band.min())
+    levels = (band.astype(np.int64) - vmin).astype(np.intp)
+    nBins = int(levels.max()) + 1
+    binWidth = int(math.ceil(math.sqrt(nBins)))
+    nCoarse = (nBins + binWidth - 1) // binWidth
+    stripWidth = max(1, maxBins // (nCoarse * binWidth))
+
+    median = np.empty((row, col))
+    for c0 in xrange(0, col, stripWidth):
+        cols = np.arange(c0, min(c0 + stripWidth, col))
+        index = np.arange(cols.size)
+        fine = np.zeros((cols.size, nCoarse, binWidth), dtype=np.int32)
+        coarse = np.zeros((cols.size, nCoarse), dtype=np.int32)
+        colCount = ydown[cols] - yup[cols]
+
+        def update(i, sign):
+            # add (sign = 1) or remove (sign = -1) image row i in every column window of the strip
+            for d in xrange(-win_offset, win_offset):
+                src = cols + d
+                valid = (src >= 0) & (src < col)
+                if mask is not None:
+                    valid[valid] = mask[i, src[valid]]
+                v = levels[i, src[valid]]
+                fine[index[valid], v // binWidth, v % binWidth] += sign
+                coarse[index[valid], v // binWidth] += sign
+
+        def select(rank, cum):
+            # value of the rank-th (0-based) element of every column window, given the coarse cumulative counts
+            cb = np.minimum((cum <= rank[:, None]).sum(1), nCoarse - 1)
+            before = np.where(cb > 0, cum[index, cb - 1], 0)
+            fb = (fine[index, cb].cumsum(1) <= (rank - before)[:, None]).sum(1)
+            return cb * binWidth + fb
+
+        for i in xrange(xleft[0], xright[0]):
+            update(i, 1)
+        for i in xrange(row):
+            if i > 0:
+                for k in xrange(xright[i - 1], xright[i]):
+                    update(k, 1)
+                for k in xrange(xleft[i - 1], xleft[i]):
+                    update(k, -1)
+
+            count = (xright[i] - xleft[i]) * colCount if mask is None else counts[i, cols]
+            cum = coarse.cumsum(1)
+            median[i, cols] = (select((count - 1) // 2, cum) + select(count // 2, cum)) / 2.0 + vmin
+            median[i, cols[count == 0]] = np.nan
+
+    return median
+
+def rankFilterMedian(band, windowSize, mask=None):
+    # The full windows are 2*win_offset wide and start win_offset before the pixel, which is
+    # where ndimage puts a footprint of that size. With an even count the median is the mean
+    # of the two middle ranks. The truncated windows along the edges, and the windows holding
+    # pixels where mask is False, are done one at a time.
+    row, col = band.shape
+    win_offset = int(windowSize/2)
+    median = np.empty((row, col))
+    if win_offset == 0:
+        median.fill(np.nan)
+        return median
+
+    band = band.astype('f8')
+    size = 2 * win_offset
+    n = size * size
+    median[:] = (ndi.rank_filter(band, n // 2 - 1, size) + ndi.rank_filter(band, n // 2, size)) / 2.0
+
+    xleft, xright = LocalStatistics.bounds(row, win_offset)
+    yup, ydown = LocalStatistics.bounds(col, win_offset)
+    fullRows = (xright - xleft) == size
+    fullCols = (ydown - yup) == size
+    irregular = ~(fullRows[:, None] & fullCols[None, :])
+    if mask is not None:
+        invalid = LocalStatistics.boxSum(summedAreaTable((~mask).astype('f8')), xleft, xright, yup, ydown)
+        irregular |= invalid > 0
+    for i, j in np.argwhere(irregular):
+        window = band[xleft[i]:xright[i], yup[j]:ydown[j]]
+        if mask is not None:
+            window = window[mask[xleft[i]:xright[i], yup[j]:ydown[j]]]
+        median[i, j] = np.median(window) if window.size else np.nan
+
+    return median
+
+def adaptiveMedian(band, maxWindowSize, maxElements=1 << 22, mask=None):
+    # Adaptive median filter: each pixel's centred window grows from 3x3 up to maxWindowSize
+    # until its median is not an impulse (zmin < zmed < zmax). The pixel is kept if it is not an
+    # impulse itself and replaced by zmed otherwise. Each window size is evaluated in one batch,
+    # and only over the pixels that are still unresolved. Pixels where mask is 0 are left out of
+    # the windows: they are sorted last as +inf and the ranks are taken among the valid ones.
+    band = np.asarray(band)
+    row, col = band.shape
+    maxOffset = int(maxWindowSize/2)
+    mask = validMask(mask)
+    padded = np.pad(band if mask is None else np.where(mask, band, np.inf), maxOffset, mode='symmetric')
+    strides = padded.strides
+
+    out = np.array(band, dtype='f8')
+    pending = np.arange(band.size)
+    for windowSize in xrange(3, 2 * maxOffset + 2, 2):
+        if not pending.size:
+            break
+        start = maxOffset - windowSize // 2
+        view = np.lib.stride_tricks.as_strided(padded[start:, start:], shape=(row, col, windowSize, windowSize),
+                                               strides=strides + strides)
+        n = windowSize * windowSize
+        last = windowSize + 2 > 2 * maxOffset + 1
+        unresolved = []
+        chunk = max(1, maxElements // n)
+        for c0 in xrange(0, pending.size, chunk):
+            index = pending[c0:c0 + chunk]
+            i, j = index // col, index % col
+            if mask is None:
+                windows = np.partition(view[i, j].reshape(-1, n), (0, n // 2, n - 1), axis=1)
+                zmin, zmed, zmax = windows[:, 0], windows[:, n // 2], windows[:, n - 1]
+            else:
+                windows = np.sort(view[i, j].reshape(-1, n), axis=1)
+                count = np.maximum(np.isfinite(windows).sum(1), 1)
+                rows = np.arange(windows.shape[0])
+                zmin, zmed, zmax = windows[:, 0], windows[rows, count // 2], windows[rows, count - 1]
+            zxy = band[i, j]
+
+            stageA = (zmed > zmin) & (zmed < zmax)
+            resolved = stageA | last
+            value = np.where(stageA & (zxy > zmin) & (zxy < zmax), zxy, zmed)
+            out[i[resolved], j[resolved]] = value[resolved]
+            unresolved.append(index[~resolved])
+        pending = np.concatenate(unresolved)
+
+    return out
+
+# ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
+
+"""
+References:
+    [1]. T. Huang, G. Yang and G. Tang. A fast two-dimensional median filtering algorithm.
+    IEEE Transactions on Acoustics, Speech, and Signal Processing, 27(1), 1979, pp. 13-18.
+
+    [2]. S. Perreault and P. Hebert. Median Filtering in Constant Time.
+    IEEE Transactions on Image Processing, 16(9), 2007, pp. 2389-2394.
+
+    [3]. R. C. Gonzalez and R. E. Woods. Digital Image Processing, 3rd ed., 2008. Section 5.3.3,
+    Adaptive Median Filter.
+"""
@@ -1,6 +1,7 @@
 import math
 import numpy as np
-from scipy import ndimage as ndi, stats
+from scipy import ndimage as ndi
+from LocalStatistics import cropPadding, centralMoments
 
 
 class TextureAnalysis():
@@ -24,9 +25,10 @@ class TextureAnalysis():
                 'dataType': 'string',
                 'value': 'Variance',
                 'required': True,
-                'domain': ('Variance', 'Skewness', 'Kurtosis'),
+                'domain': ('Variance', 'Skewness', 'Kurtosis', 'All'),
                 'displayName': "Texture Analysis Operator",
-                'description': "Mathematical formula for texture analysis."
+                'description': "Mathematical formula for texture analysis. All outputs the variance, skewness and kurtosis of every band, "
+                               "in that order, from the same local moments."
             },
             {
                 'name': 'win',
@@ -40,11 +42,14 @@ class TextureAnalysis():
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties': 4 | 8,           # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # no padding to the input pixel block.
-          'inputMask': False                    # input mask in .updatePixels() not required.
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave masked pixels (NoData and the fill outside the raster) out of the windows
          }
 
     def updateRasterInfo(self, **kwargs):
@@ -53,14 +58,16 @@ class TextureAnalysis():
         self.windowSize = windowSizeTemp if (windowSizeTemp % 2 != 0) else windowSizeTemp + 1
 
         mode = kwargs['mode'].lower()
-        if mode == "variance": self.op = ndi.variance
-        elif mode == "skewness": self.op = stats.skew
-        else: self.op = stats.kurtosis
+        if mode == "variance": self.ops = ('Variance',)
+        elif mode == "skewness": self.ops = ('Skewness',)
+        elif mode == "all": self.ops = ('Variance', 'Skewness', 'Kurtosis')
+        else: self.ops = ('Kurtosis',)
+        self.order = 2 if self.ops == ('Variance',) else 4 if 'Kurtosis' in self.ops else 3
 
         self.bandCount = kwargs['raster_info']['bandCount']
                 
         # output raster information
-        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount']
+        kwargs['output_info']['bandCount'] = kwargs['raster_info']['bandCount'] * len(self.ops)
         kwargs['output_info']['pixelType'] = 'u2'
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
@@ -69,17 +76,39 @@ class TextureAnalysis():
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
 
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
-        outBlock = np.zeros_like(r)
+        outBlock = np.zeros((len(self.ops) * self.bandCount,) + r.shape[1:], dtype=r.dtype)
+        mask = pixelBlocks.get('raster_mask')
 
         for band in xrange(self.bandCount):
-            outBlock[band] = ndi.generic_filter(r[band], self.op, (self.windowSize,self.windowSize))
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+            valid = None if mask is None else mask[band] != 0
+            localMean, m = centralMoments(r[band], self.windowSize, self.order, valid)
+            if self.order > 2:
+                # flat windows have no skewness and a kurtosis of -3, as in scipy.stats
+                high = r[band] if valid is None else np.where(valid, r[band], -np.inf)
+                low = r[band] if valid is None else np.where(valid, r[band], np.inf)
+                flat = ndi.maximum_filter(high, self.windowSize) == ndi.minimum_filter(low, self.windowSize)
+                m2 = np.where(flat, 1.0, m[2])
+
+            for k, op in enumerate(self.ops):
+                if op == 'Variance':
+                    t = m[2]
+                elif op == 'Skewness':
+                    t = np.where(flat, 0.0, m[3] / m2 ** 1.5)
+                else:
+                    t = np.where(flat, 0.0, m[4] / (m2 * m2)) - 3.0
+                outBlock[k * self.bandCount + band] = t
+
+        pixelBlocks['output_pixels'] = cropPadding(outBlock, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(np.tile(mask, (len(self.ops), 1, 1)), self.padding)
 
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
+        elif len(self.ops) > 1:                         # name the output bands of each operator
+            keyMetadata['bandname'] = "{0}_{1}".format(self.ops[bandIndex // self.bandCount], bandIndex % self.bandCount + 1)
         return keyMetadata
 
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
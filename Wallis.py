@@ -1,6 +1,6 @@
 import math
 import numpy as np
-from scipy import ndimage as ndi
+from LocalStatistics import cropPadding, centralMoments
 
 class Wallis():
 
@@ -62,11 +62,14 @@ class Wallis():
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties': 2 | 4 | 8,       # inherit everything but the pixel type (1)
           'invalidateProperties': 2 | 4 | 8,    # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                         # no padding of the input pixel block
-          'inputMask': False                    # we don't need the input mask in .updatePixels()
+          'padding': self.padding,              # pad the input pixel block by half the window size.
+          'inputMask': True                     # leave masked pixels (NoData and the fill outside the raster) out of the windows
         }
 
     def updateRasterInfo(self, **kwargs):
@@ -94,25 +97,35 @@ class Wallis():
         # get input raster for applying wallis filter
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
         outBlock = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False)
+        mask = pixelBlocks.get('raster_mask')
 
         for band in xrange(self.bandCount):
             rBand = r[band]
-            row = rBand.shape[0]
-            col = rBand.shape[1]
 
-            rBand = rBand.reshape((1,row,col))
+            # calculate local statistics from box filters of x and x*x
+            localmean, moments = centralMoments(rBand, self.windowSize, mask=None if mask is None else mask[band])
+            localmean = localmean.astype('f4')
+            localstddev = np.sqrt(moments[2]).astype('f4')
+
+            # apply wallis normalization filter in place, in float32:
+            # sqrt(dsStd / (1/maxGain + localstddev)) * (rBand - localmean) + alpha * dsMean + (1 - alpha) * localmean
+            gain = localstddev
+            gain += (1 / self.maxGain)
+            np.divide(self.dsStd, gain, out=gain)
+            np.sqrt(gain, out=gain)
 
-            # calculate local statistics
-            localmean = ndi.uniform_filter(rBand, self.windowSize)
-            localstddev = ndi.generic_filter(rBand, np.std, self.windowSize)
+            outBlockBand = np.subtract(rBand, localmean)
+            outBlockBand *= gain
+            localmean *= (1 - self.alpha)
+            outBlockBand += localmean
+            outBlockBand += (self.alpha * self.dsMean)
 
-            # apply wallis normalization filter, output pixel array with wallis filter applied
-            outBlockBand = np.sqrt(self.dsStd/((1 / self.maxGain) + localstddev)) * (rBand - localmean) + (self.alpha * self.dsMean) + ((1 - self.alpha) * localmean) 
-            
-            outBlock[band] = outBlockBand.reshape((row,col))
+            outBlock[band] = outBlockBand
 
 
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+        pixelBlocks['output_pixels'] = cropPadding(outBlock, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(mask, self.padding)
         return pixelBlocks
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
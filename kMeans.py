@@ -1,6 +1,17 @@
+import os
 import math
+import time
+import logging
+import tempfile
+import threading
 import numpy as np
-from sklearn.cluster import k_means,KMeans
+from sklearn.cluster import k_means,KMeans,MiniBatchKMeans
+
+# streaming models and Train Once centroids shared by every instance of the function in the process,
+# by raster (or centroid file) and parameters
+modelCache = {}
+modelLock = threading.Lock()
+logger = logging.getLogger(__name__)
 
 class kMeans():
 
@@ -42,6 +53,56 @@ class kMeans():
                 'displayName': "Number of iterations (of k means algorithm)",
                 'description': "Number of time the k-means algorithm will be run with different centroid seeds. The final results will be the best output of n_init consecutive runs in terms of inertia."
             },
+            {
+                'name': 'training',
+                'dataType': 'string',
+                'value': 'Per Tile',
+                'required': False,
+                'domain': ('Per Tile', 'Train Once', 'Streaming'),
+                'displayName': "Training",
+                'description': "Per Tile fits new centroids for every pixel block. Train Once fits them on the first block "
+                               "(or loads them from the centroid file) and labels every block with the same centroids. "
+                               "Without a centroid file those centroids are shared only within one process, so separate "
+                               "processes (parallel processing) may number the same clusters differently. "
+                               "Streaming refines mini-batch centroids with every block until they converge, then only labels."
+            },
+            {
+                'name': 'tolerance',
+                'dataType': 'numeric',
+                'value': 0.001,
+                'required': False,
+                'displayName': "Streaming Tolerance",
+                'description': "Streaming stops refining the centroids once a block moves them by less than this fraction of their norm."
+            },
+            {
+                'name': 'centroids',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Centroid File",
+                'description': "Text file of Train Once centroids. Centroids are loaded from it if it exists, and saved to it after training "
+                               "otherwise, so every process that renders the raster labels it with the same centroids."
+            },
+            {
+                'name': 'dataset',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Dataset Name",
+                'description': "Name or path of the input raster. Streaming models and Train Once centroids without a centroid file "
+                               "are shared by the rasters with the same name, properties and statistics, so enter it whenever "
+                               "two inputs could share extent, cell size and statistics."
+            },
+            {
+                'name': 'output',
+                'dataType': 'string',
+                'value': 'Per Band',
+                'required': False,
+                'domain': ('Per Band', 'Joint'),
+                'displayName': "Output",
+                'description': "Per Band clusters every band on its own and outputs one label band per input band. "
+                               "Joint clusters the pixels on all bands together and outputs a single label band."
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -57,105 +118,180 @@ class kMeans():
         self.cluster = kwargs['cluster']
         self.iter = kwargs['iter']
         self.n_init = int(kwargs['n_init'])
+        self.trainOnce = kwargs.get('training', 'Per Tile') == 'Train Once'
+        self.streaming = kwargs.get('training', 'Per Tile') == 'Streaming'
+        self.tolerance = float(kwargs.get('tolerance', 0.001))
+        self.centroidFile = kwargs.get('centroids', '')
+        self.joint = kwargs.get('output', 'Per Band') == 'Joint'
+        self.bandCount = kwargs['raster_info']['bandCount']
 
-        # output raster information
+        # streaming models, or trained centroids ((clusters, dimensions) for every band or for the joint model),
+        # of this raster and these parameters, created by the first instance that needs them
         r = kwargs['raster_info']
-        if r['bandCount'] == 4:
-            kwargs['output_info']['bandCount'] = 4
-            kwargs['output_info']['pixelType'] = 'u2'
-            kwargs['output_info']['statistics'] = ({'minimum': 0, 'maximum': self.cluster - 1})
-            return kwargs
-        elif r['bandCount'] == 2 :
-            kwargs['output_info']['bandCount'] = 2
-            kwargs['output_info']['pixelType'] = 'u2'
-            kwargs['output_info']['statistics'] = ({'minimum': 0, 'maximum': self.cluster - 1})
-            return kwargs
-        elif r['bandCount'] == 1 :
-            kwargs['output_info']['bandCount'] = 1
-            kwargs['output_info']['pixelType'] = 'u2'
-            kwargs['output_info']['statistics'] = ({'minimum': 0, 'maximum': self.cluster - 1})
-            return kwargs
+        key = (str(kwargs.get('dataset', '')),)
+        key += tuple(str(r.get(k)) for k in ('extent', 'cellSize', 'spatialReference', 'bandCount', 'pixelType',
+                                             'statistics', 'histogram'))
+        key += (int(self.cluster), self.n_init, self.joint)
+        if self.trainOnce:
+            # a centroid file identifies the model on its own, whatever raster it is applied to
+            if self.centroidFile:
+                key = (os.path.abspath(self.centroidFile), self.bandCount, int(self.cluster), self.joint)
+            key = ('Train Once', int(self.iter)) + key
+            with modelLock:
+                self.centroids, self.trainLock = modelCache.setdefault(key, ({}, threading.Lock()))
+            with self.trainLock:
+                self.loadCentroids()
+        if self.streaming:
+            with modelLock:
+                self.models = modelCache.setdefault(key, {})
+
+        self.labelBuffers = {}                  # u2 label blocks, by block shape
+        self.timings = {}                       # seconds spent in each step of the last block
+
+        # output raster information
+        kwargs['output_info']['bandCount'] = 1 if self.joint else self.bandCount
+        kwargs['output_info']['pixelType'] = 'u2'
+        kwargs['output_info']['statistics'] = ({'minimum': 0, 'maximum': self.cluster - 1})
+        return kwargs
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
-        # get the primary input raster    
-        
+        start = time.time()
+        self.timings = {'fit': 0.0, 'label': 0.0}
+
+        # get the primary input raster
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
-        rStr = str(r)
-        rStrShape = str(r.shape)
-
-        if(np.shape(r)[0]==1):
-            r3 = r.ravel()
-            r4 = r3.reshape((r3.shape[0],1))
-
-            km = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(r4)
-            j = km.predict(r4)
-
-            k = j.reshape((r.shape))
-            kstr = str(k)
-
-            pixelBlocks['output_pixels'] = k.astype(props['pixelType'], copy=False)
-            return pixelBlocks
-
-        elif(np.shape(r)[0]==2):
-            first_band = np.array(r[0])
-            second_band = np.array(r[1])
-            fb_ravel = first_band.ravel()
-            sb_ravel = second_band.ravel()
-            fb = fb_ravel.reshape((fb_ravel.shape[0],1))
-            sb = sb_ravel.reshape((sb_ravel.shape[0],1))
-           
-            km1 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(fb)
-            km2 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(sb)
-            j1 = km1.predict(fb)
-            j2 = km2.predict(sb)
-
-            k1 = j1.reshape((first_band.shape))
-            k2 = j2.reshape((second_band.shape))
-
-            pixelBlocks['output_pixels'] = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False) 
-            pixelBlocks['output_pixels'][0] = k1.astype(props['pixelType'], copy=False)
-            pixelBlocks['output_pixels'][1] = k2.astype(props['pixelType'], copy=False)
-
-            return pixelBlocks
-
-        elif(np.shape(r)[0]==4):
-            
-            first_band = np.array(r[0])
-            second_band = np.array(r[1])
-            third_band = np.array(r[2])
-            fourth_band = np.array(r[3])
-            fb_ravel = first_band.ravel()
-            sb_ravel = second_band.ravel()
-            tb_ravel = third_band.ravel()
-            fth_ravel = fourth_band.ravel()
-
-            fb = fb_ravel.reshape((fb_ravel.shape[0],1))
-            sb = sb_ravel.reshape((sb_ravel.shape[0],1))
-            tb = tb_ravel.reshape((tb_ravel.shape[0],1))
-            fthb = fth_ravel.reshape((fth_ravel.shape[0],1))
-
-            km1 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(fb)
-            km2 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(sb)
-            km3 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(tb)
-            km4 = KMeans(int(self.cluster),'k-means++',self.n_init,int(self.iter)).fit(fthb)
-
-            j1 = km1.predict(fb)
-            j2 = km2.predict(sb)
-            j3 = km3.predict(tb)
-            j4 = km4.predict(fthb)
-
-            k1 = j1.reshape((first_band.shape))
-            k2 = j2.reshape((second_band.shape))
-            k3 = j3.reshape((third_band.shape))
-            k4 = j4.reshape((fourth_band.shape))
-
-            pixelBlocks['output_pixels'] = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False) 
-            pixelBlocks['output_pixels'][0] = k1.astype(props['pixelType'], copy=False)
-            pixelBlocks['output_pixels'][1] = k2.astype(props['pixelType'], copy=False)
-            pixelBlocks['output_pixels'][2] = k3.astype(props['pixelType'], copy=False)
-            pixelBlocks['output_pixels'][3] = k4.astype(props['pixelType'], copy=False)
-
-            return pixelBlocks
+
+        # (pixels, bands) view of the block, each band a (pixels, 1) column of it.
+        # Single bands of u1 or u2 pixels also keep their integer values for the histogram path.
+        values = r.reshape((r.shape[0], -1)).T
+        raw = np.asarray(pixelBlocks['raster_pixels'])
+        ints = raw.reshape((raw.shape[0], -1)) if raw.dtype in (np.uint8, np.uint16) else None
+        # labels are written straight into a u2 block kept for every block shape
+        outShape = ((1,) if self.joint else r.shape[:1]) + r.shape[1:]
+        if outShape not in self.labelBuffers:
+            self.labelBuffers[outShape] = np.empty(outShape, dtype='u2')
+        k = self.labelBuffers[outShape]
+
+        # (model, values, ints, labels) of the joint model or of every band
+        if self.joint:
+            models = [('joint', values, ints[0] if ints is not None and r.shape[0] == 1 else None, k[0].reshape(-1))]
+        else:
+            models = [(band, values[:, band:band + 1], None if ints is None else ints[band], k[band].reshape(-1))
+                      for band in xrange(r.shape[0])]
+
+        if self.trainOnce:
+            self.train(models)
+        for model, modelValues, modelInts, labels in models:
+            self.classify(modelValues, model, labels, modelInts)
+
+        pixelBlocks['output_pixels'] = k.astype(props['pixelType'], copy=False)
+
+        self.timings['total'] = time.time() - start
+        logger.debug("kMeans block %s of shape %s: fit %.3f s, label %.3f s, total %.3f s",
+                     tlc, r.shape, self.timings['fit'], self.timings['label'], self.timings['total'])
+        return pixelBlocks
+
+    def classify(self, values, model, out, ints=None):
+        # cluster labels, written into the u2 array out, of the (pixels, dimensions) values of a model (a band or 'joint'), from centroids fitted
+        # on these values or, when training once, by train() on the first block seen (or read from the centroid file).
+        # ints are the same values of a single u1/u2 band, labelled through a lookup table of every value.
+        start = time.time()
+        if self.streaming:
+            centroids = self.refine(values, model)
+            ints = None
+        elif not self.trainOnce:
+            centroids = self.fit(values, ints)
+        else:
+            centroids = self.centroids[model]
+        self.timings['fit'] += time.time() - start
+
+        start = time.time()
+        if ints is not None:
+            table = nearestCentroid(np.arange(np.iinfo(ints.dtype).max + 1, dtype='f4').reshape((-1, 1)), centroids)
+            np.take(table.astype(out.dtype), ints, out=out)
+        else:
+            nearestCentroid(values, centroids, out)
+        self.timings['label'] += time.time() - start
+        return out
+
+    def train(self, models):
+        # Train Once centroids of every model, fitted on this block unless they are known already. One instance
+        # fits at a time, after checking whether another process has saved the centroid file meanwhile. After
+        # saving, the file is read back: when another process saved first, its centroids replace the ones fitted
+        # here, so every process labels with the centroids of the first writer.
+        start = time.time()
+        with self.trainLock:
+            if any(model not in self.centroids for model, _, _, _ in models):
+                self.loadCentroids()
+            missing = [(model, values, ints) for model, values, ints, _ in models if model not in self.centroids]
+            if missing:
+                self.centroids.update((model, self.fit(values, ints)) for model, values, ints in missing)
+                if self.centroidFile:
+                    self.saveCentroids()
+                    self.loadCentroids()
+        self.timings['fit'] += time.time() - start
+
+    def loadCentroids(self):
+        # centroids from the centroid file, replacing any fitted here
+        if not self.centroidFile or not os.path.exists(self.centroidFile):
+            return
+        saved = np.loadtxt(self.centroidFile, ndmin=2)
+        if self.joint and saved.shape == (int(self.cluster), self.bandCount):
+            self.centroids['joint'] = saved
+        elif not self.joint and saved.shape == (self.bandCount, int(self.cluster)):
+            self.centroids.update((band, c.reshape((-1, 1))) for band, c in enumerate(saved))
+        else:
+            raise Exception("Centroid file does not match the band count and number of clusters.")
+
+    def saveCentroids(self):
+        # write a temporary file next to the centroid file and link it to the centroid file name. Linking (or
+        # renaming on Windows) fails when the file exists, so the first process to save wins and no process
+        # ever reads a partial file.
+        if os.path.exists(self.centroidFile):
+            return
+        if self.joint:
+            saved = self.centroids['joint']
+        else:
+            saved = np.array([self.centroids[b][:, 0] for b in xrange(self.bandCount)])
+        handle, path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(os.path.abspath(self.centroidFile)))
+        try:
+            with os.fdopen(handle, 'w') as f:
+                np.savetxt(f, saved)
+            if hasattr(os, 'link'):
+                os.link(path, self.centroidFile)
+            else:
+                os.rename(path, self.centroidFile)
+        except OSError:
+            if not os.path.exists(self.centroidFile):
+                raise                                   # not lost to another process
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def refine(self, values, model):
+        # centroids of a streaming model after a mini-batch step on the block, until a step moves them
+        # by less than the tolerance; from then on the converged centroids are returned as they are
+        with modelLock:
+            if model not in self.models:
+                self.models[model] = [MiniBatchKMeans(n_clusters=int(self.cluster), init='k-means++', n_init=self.n_init), False]
+            km, converged = self.models[model]
+            if not converged:
+                previous = km.cluster_centers_.copy() if hasattr(km, 'cluster_centers_') else None
+                km.partial_fit(values)
+                if previous is not None:
+                    shift = np.sqrt(np.square(km.cluster_centers_ - previous).sum())
+                    self.models[model][1] = shift <= self.tolerance * np.sqrt(np.square(previous).sum())
+            return km.cluster_centers_.copy()
+
+    def fit(self, values, ints=None):
+        km = KMeans(n_clusters=int(self.cluster), init='k-means++', n_init=self.n_init, max_iter=int(self.iter))
+        if ints is not None:
+            # weighted k-means over the value histogram: the same objective, at a cost independent of the pixel count
+            counts = np.bincount(ints)
+            present = np.nonzero(counts)[0]
+            if present.size >= int(self.cluster):
+                return km.fit(present.reshape((-1, 1)).astype('f8'), sample_weight=counts[present]).cluster_centers_
+        return km.fit(values).cluster_centers_
 
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
@@ -166,4 +302,25 @@ class kMeans():
             keyMetadata['bandname'] = 'KMeans'
         return keyMetadata
 
+def nearestCentroid(values, centroids, out=None, maxElements=1 << 22):
+    # index of the nearest centroid (rows of centroids) of every row of values, as KMeans.predict gives it,
+    # written into out chunk by chunk so only a chunk of intp indices is allocated at a time
+    if out is None:
+        out = np.empty(values.shape[0], dtype=np.intp)
+    if centroids.shape[1] == 1:
+        # one band: search the value among the midpoints of the sorted centroids
+        order = np.argsort(centroids[:, 0])
+        sortedCentroids = centroids[order, 0]
+        midpoints = (sortedCentroids[1:] + sortedCentroids[:-1]) / 2
+        for i in xrange(0, values.shape[0], maxElements):
+            out[i:i + maxElements] = order[np.searchsorted(midpoints, values[i:i + maxElements, 0])]
+        return out
+
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, and |x|^2 does not change the nearest centroid
+    norms = np.square(centroids).sum(1)
+    rows = max(1, maxElements // len(centroids))
+    for i in xrange(0, values.shape[0], rows):
+        out[i:i + rows] = np.argmin(norms - 2.0 * np.dot(values[i:i + rows], centroids.T), axis=1)
+    return out
+
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
@@ -1,6 +1,8 @@
 import numpy as np
 from scipy import signal
 import math
+from LocalStatistics import cropPadding
+from SlidingMedian import slidingMedian, adaptiveMedian
 
 class localAdaptiveMedianFilter():
 
@@ -26,15 +28,29 @@ class localAdaptiveMedianFilter():
                 'displayName': "Moving Window Size",
                 'description': "Enter size of square data window for computation of local mean and deviation."
                                "Must be an odd number. If you enter an even number, function automatically adds one (+1) to make the number odd."
+                               "In Adaptive mode this is the maximum size the window may grow to."
+            },
+            {
+                'name': 'mode',
+                'dataType': 'string',
+                'value': 'Fixed',
+                'required': True,
+                'domain': ('Fixed', 'Adaptive'),
+                'displayName': "Median Mode",
+                'description': "Fixed applies a median over the moving window. Adaptive grows the window from 3x3 up to the moving window size "
+                               "until the local median is not an impulse, and only replaces pixels that are impulses themselves."
             },
         ]
 
     def getConfiguration(self, **scalars):
+        windowSize = int(scalars.get('win', 3))
+        self.padding = (windowSize if (windowSize % 2 != 0) else windowSize + 1) // 2
+
         return {
           'inheritProperties':  4 | 8,              # inherit everything but the pixel type (1) and NoData (2)
           'invalidateProperties': 2 | 4 | 8,        # invalidate these aspects because we are modifying pixel values and updating key properties.
-          'padding': 0,                             # no padding of the input pixel block
-          'inputMask': False                        # we don't need the input mask in .updatePixels()
+          'padding': self.padding,                  # pad the input pixel block by half the window size.
+          'inputMask': True                         # leave masked pixels (NoData and the fill outside the raster) out of the windows
         }
 
     def updateRasterInfo(self, **kwargs):
@@ -43,6 +59,7 @@ class localAdaptiveMedianFilter():
         self.bandCount = kwargs['raster_info']['bandCount']
         windowSize = int(kwargs.get('win', 3))
         self.windowSize = windowSize if (windowSize % 2 != 0) else windowSize + 1  # moving window size
+        self.adaptive = kwargs.get('mode', 'Fixed').lower() == 'adaptive'
         kwargs['output_info']['pixelType'] = kwargs['raster_info']['pixelType']
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
@@ -52,35 +69,20 @@ class localAdaptiveMedianFilter():
 
 
     def updatePixels(self, tlc, shape, props, **pixelBlocks):
-        r = np.array(pixelBlocks['raster_pixels'], dtype ='f4', copy=False)
+        r = np.asarray(pixelBlocks['raster_pixels'])     # keep integer pixels for the histogram median
         outBlock = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False)
-        row = r.shape[1]
-        col = r.shape[2]
-        win_offset = int(self.windowSize/2)
+        mask = pixelBlocks.get('raster_mask')
 
         for band in xrange(self.bandCount):
-            for i in xrange(row):
-                xleft = i - win_offset
-                xright = i + win_offset
-                if xleft < 0:
-                    xleft = 0
-                if xright >= row:
-                    xright = row
-                for j in xrange(col):
-                    yup = j - win_offset
-                    ydown = j + win_offset
-                    if yup < 0:
-                        yup = 0
-                    if ydown >= col:
-                        ydown = col
-
-                    pix_value = r[band][i, j]
-                    window = r[band][xleft:xright, yup:ydown]
-                    new_pix_value = np.median(window)
-                    outBlock[band][i, j] = np.round(new_pix_value)
-
-
-        pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
+            valid = None if mask is None else mask[band]
+            if self.adaptive:
+                outBlock[band] = np.round(adaptiveMedian(r[band], self.windowSize, mask=valid))
+            else:
+                outBlock[band] = np.round(slidingMedian(r[band], self.windowSize, mask=valid))
+
+        pixelBlocks['output_pixels'] = cropPadding(outBlock, self.padding).astype(props['pixelType'], copy=False)
+        if mask is not None:
+            pixelBlocks['output_mask'] = cropPadding(mask, self.padding)
         return pixelBlocks
 
 
@@ -1,7 +1,14 @@
 import numpy as np
 from skimage import restoration
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import threading
 import math
 
+# per-band noise estimates shared by every instance of the function in the process, by raster
+noiseCache = {}
+noiseLock = threading.Lock()
+
 class nlMeans():
 
     def __init__(self):
@@ -42,6 +49,60 @@ class nlMeans():
                 'displayName': "Cut-off distance",
                 'description': "The higher h, the more permissive one is in accepting patches. A higher h results in a smoother image, at the expense of blurring features. For a Gaussian noise of standard deviation sigma, a rule of thumb is to choose the value of h to be sigma of slightly less."
             },
+            {
+                'name': 'sigma',
+                'dataType': 'numeric',
+                'value': 0.0,
+                'required': False,
+                'displayName': "Noise Standard Deviation",
+                'description': "Standard deviation of the noise, subtracted from the patch distances. 0 subtracts nothing."
+            },
+            {
+                'name': 'estimate',
+                'dataType': 'boolean',
+                'value': False,
+                'required': False,
+                'displayName': "Estimate Noise",
+                'description': "With a Noise Standard Deviation of 0, estimate it for each band instead. The estimate is made "
+                               "from the first tile the process renders and shared by every instance of the function in the "
+                               "process. Separate processes (parallel processing) make their own estimates, so enter a "
+                               "Noise Standard Deviation when the output must be seamless across processes."
+            },
+            {
+                'name': 'dataset',
+                'dataType': 'string',
+                'value': '',
+                'required': False,
+                'displayName': "Dataset Name",
+                'description': "Name or path of the input raster. Noise estimates are shared by the rasters with the same name, "
+                               "properties and statistics, so enter it whenever two inputs could share extent, cell size and statistics."
+            },
+            {
+                'name': 'fast_mode',
+                'dataType': 'boolean',
+                'value': True,
+                'required': False,
+                'displayName': "Fast Mode",
+                'description': "Compute patch distances with integral images (uniform patch weights). Turn off for the slower pixelwise algorithm with Gaussian patch weights."
+            },
+            {
+                'name': 'mode',
+                'dataType': 'string',
+                'value': 'Per Band',
+                'required': False,
+                'domain': ('Per Band', 'Joint'),
+                'displayName': "Band Processing",
+                'description': "Per Band denoises each band on its own. Joint computes patch distances once over all bands "
+                               "(or the guide band) and applies the same weights to every band."
+            },
+            {
+                'name': 'guide',
+                'dataType': 'numeric',
+                'value': 0,
+                'required': False,
+                'displayName': "Guide Band",
+                'description': "Band (1 for the first band) whose patches alone decide the Joint weights. Enter 0 to use all bands."
+            },
         ]
 
     def getConfiguration(self, **scalars):
@@ -59,6 +120,22 @@ class nlMeans():
         self.patch_size = int(kwargs.get('patch_size'))
         self.patch_distance = int(kwargs.get('patch_distance'))
         self.cutOff_distance = float(kwargs.get('cutOffDistance',0.1))
+        self.sigma = float(kwargs.get('sigma', 0.0))
+        self.estimate = bool(kwargs.get('estimate', False)) and self.sigma <= 0
+        if self.estimate:
+            # per-band noise estimate of this raster, made on the first tile by the first instance that needs it
+            r = kwargs['raster_info']
+            key = (str(kwargs.get('dataset', '')),)
+            key += tuple(str(r.get(k)) for k in ('extent', 'cellSize', 'spatialReference', 'bandCount', 'pixelType',
+                                                 'statistics', 'histogram'))
+            with noiseLock:
+                self.noise = noiseCache.setdefault(key, {})
+        self.fast_mode = bool(kwargs.get('fast_mode', True))
+        self.joint = kwargs.get('mode', 'Per Band') == 'Joint' and self.bandCount > 1
+        self.guide = int(kwargs.get('guide', 0))
+        if self.guide < 0 or self.guide > self.bandCount:
+            raise Exception("Guide band out of range.")
+        self.threads = max(1, min(self.bandCount, multiprocessing.cpu_count()))
         kwargs['output_info']['pixelType'] = kwargs['raster_info']['pixelType']
         kwargs['output_info']['statistics'] = ()
         kwargs['output_info']['histogram'] = ()
@@ -71,16 +148,61 @@ class nlMeans():
         r = np.array(pixelBlocks['raster_pixels'], dtype='f4', copy=False)
         outBlock = pixelBlocks['raster_pixels'].astype(props['pixelType'],copy=False)
 
+        sigmas = self.noiseSigmas(r)
+
+        # the denoising core releases the GIL, so bands are filtered on worker threads
+        if self.joint:
+            denoised = self.denoiseJoint(r, sigmas)
+        elif self.threads > 1:
+            pool = ThreadPool(self.threads)
+            try:
+                denoised = pool.map(lambda band: self.denoise(r[band], sigmas[band]), xrange(self.bandCount))
+            finally:
+                pool.close()
+        else:
+            denoised = [self.denoise(r[band], sigmas[band]) for band in xrange(self.bandCount)]
+
         for band in xrange(self.bandCount):
-            rBand = r[band]
-            row = rBand.shape[0]
-            col = rBand.shape[1]
-            outBlock[band] = restoration.denoise_nl_means(rBand, self.patch_size, self.patch_distance, self.cutOff_distance)
+            outBlock[band] = denoised[band]
 
         pixelBlocks['output_pixels'] = outBlock.astype(props['pixelType'], copy=False)
         return pixelBlocks
 
 
+    def noiseSigmas(self, r):
+        # noise standard deviation of each band; an estimate comes from the first tile the process renders,
+        # so every tile of the process subtracts the same value
+        if not self.estimate:
+            return np.full(self.bandCount, max(self.sigma, 0.0))
+        with noiseLock:
+            if 'sigma' not in self.noise:
+                self.noise['sigma'] = np.array([estimateNoise(rBand) for rBand in r])
+            return self.noise['sigma']
+
+    def denoise(self, rBand, sigma):
+        return denoiseNLMeans(rBand, None, patch_size=self.patch_size, patch_distance=self.patch_distance,
+                              h=self.cutOff_distance, sigma=sigma, fast_mode=self.fast_mode)
+
+    def denoiseJoint(self, r, sigmas):
+        # One multichannel pass: the patch distance is the mean of the band distances and the weights are shared.
+        # With a guide band, the other bands are scaled down until their distances vanish and the guide is scaled
+        # by sqrt(bandCount) so its mean distance is unchanged. The outputs are scaled back, which is exact
+        # because every output band is a weighted mean of its own input band.
+        stack = np.array(r, dtype='f8')
+        if self.guide == 0:
+            sigma = np.sqrt(np.mean(np.square(sigmas)))
+            scale = np.ones(self.bandCount)
+        else:
+            sigma = sigmas[self.guide - 1]
+            spread = np.array([np.ptp(b) if b.size and np.ptp(b) > 0 else 1.0 for b in stack])
+            scale = 1e-6 * spread[self.guide - 1] / spread
+            scale[self.guide - 1] = np.sqrt(self.bandCount)
+        stack *= scale[:, None, None]
+
+        denoised = denoiseNLMeans(np.moveaxis(stack, 0, -1), -1, patch_size=self.patch_size, patch_distance=self.patch_distance,
+                                  h=self.cutOff_distance, sigma=sigma, fast_mode=self.fast_mode)
+        return np.moveaxis(denoised, -1, 0) / scale[:, None, None]
+
     def updateKeyMetadata(self, names, bandIndex, **keyMetadata):
         if bandIndex == -1:                             # dataset-level properties
             keyMetadata['datatype'] = 'Processed'       # outgoing dataset is now 'Processed'
@@ -90,6 +212,21 @@ class nlMeans():
             keyMetadata['bandname'] = 'nlMeans'
         return keyMetadata
 
+def estimateNoise(band):
+    # Gaussian noise standard deviation from the median absolute deviation of the finest diagonal
+    # Haar wavelet coefficients (Donoho and Johnstone), which image structure hardly reaches
+    x = np.asarray(band, dtype='f8')
+    x = x[:x.shape[0] // 2 * 2, :x.shape[1] // 2 * 2]
+    detail = (x[0::2, 0::2] - x[0::2, 1::2] - x[1::2, 0::2] + x[1::2, 1::2]) / 2.0
+    return np.median(np.abs(detail)) / 0.6745 if detail.size else 0.0
+
+def denoiseNLMeans(image, channel_axis, **kwargs):
+    # denoise_nl_means with the channel axis given as channel_axis (scikit-image >= 0.19) or multichannel
+    try:
+        return restoration.denoise_nl_means(image, channel_axis=channel_axis, **kwargs)
+    except TypeError:
+        return restoration.denoise_nl_means(image, multichannel=channel_axis is not None, **kwargs)
+
 # ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ## ----- ##
 
 """
@@ -106,4 +243,7 @@ references:
     .. [3] Jacques Froment. Parameter-Free Fast Pixelwise Non-Local Means
            Denoising. Image Processing On Line, 2014, vol. 4, p. 300-326.
 
+    .. [4] D. L. Donoho and I. M. Johnstone. Ideal spatial adaptation by
+           wavelet shrinkage. Biometrika, 81(3), 1994, pp. 425-455.
+
 """
\ No newline at end of file